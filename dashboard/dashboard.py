@@ -1,6 +1,7 @@
 import os
 import streamlit as st
 import pandas as pd
+import polars as pl
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -15,10 +16,23 @@ st.set_page_config(
     layout="wide"
 )
 
+# Write Parquet files atomically
+
+
+def write_parquet_atomic(df, path):
+    # A killed process leaves only the temp file behind, never a truncated target
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        df.write_parquet(temp_path, compression='zstd')
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 # Load data
 
 
-@st.cache_data
+@st.cache_resource
 def load_data():
     current_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -33,31 +47,53 @@ def load_data():
         os.path.join(parent_dir, 'main_data.csv')
     ]
 
-    df = None
+    csv_path = None
     for path in possible_paths:
         if os.path.exists(path):
-            df = pd.read_csv(path)
+            csv_path = path
             break
 
     # If file wasn't found in either location
-    if df is None:
+    if csv_path is None:
         st.error("Could not find main_data.csv. Please check the file location.")
         st.stop()
 
-    # Convert datetime columns
+    # Reuse the Parquet copy unless the CSV or this script (and so the read
+    # schema) changed after it was written
+    parquet_path = os.path.splitext(csv_path)[0] + '.parquet'
+    built_after = max(os.path.getmtime(csv_path),
+                      os.path.getmtime(os.path.abspath(__file__)))
+    if os.path.exists(parquet_path) and \
+            os.path.getmtime(parquet_path) >= built_after:
+        return pl.scan_parquet(parquet_path), parquet_path
+
+    # Column dtypes are set by polars while reading
     datetime_columns = ['order_purchase_timestamp', 'order_approved_at',
                         'order_delivered_carrier_date', 'order_delivered_customer_date',
                         'order_estimated_delivery_date']
+    category_columns = ['payment_type', 'customer_state',
+                        'product_category_name_english']
+    string_columns = ['customer_id', 'order_id']
+
+    schema_overrides = {column: pl.Datetime for column in datetime_columns}
+    schema_overrides.update(
+        {column: pl.Categorical for column in category_columns})
+    schema_overrides.update({column: pl.String for column in string_columns})
 
-    for column in datetime_columns:
-        if column in df.columns:
-            df[column] = pd.to_datetime(df[column])
-    return df
+    df = pl.read_csv(csv_path, schema_overrides=schema_overrides,
+                     try_parse_dates=True, low_memory=True)
+
+    # Save a Parquet copy so later loads skip CSV parsing
+    try:
+        write_parquet_atomic(df, parquet_path)
+    except OSError:
+        return df.lazy(), csv_path
+    return pl.scan_parquet(parquet_path), parquet_path
 
 
 # Display loading message
 with st.spinner('Loading data...'):
-    all_df = load_data()
+    all_lf, data_path = load_data()
 
 # Title and introduction
 st.title('🛒 E-Commerce Data Analysis Dashboard')
@@ -77,116 +113,261 @@ options = st.sidebar.radio('Select a section:',
 # Create monthly aggregation for trend analysis
 
 
-@st.cache_data
-def prepare_monthly_data(df):
-    monthly_orders_df = df.groupby(pd.Grouper(key='order_purchase_timestamp', freq='M')).agg({
-        "order_id": lambda x: x.nunique(),
-        "price": "sum"
-    }).reset_index()
+def monthly_query(lf):
+    monthly_orders = lf.group_by(
+        pl.col('order_purchase_timestamp').dt.truncate('1mo').alias('order_date')
+    ).agg(
+        order_count=pl.col('order_id').n_unique(),
+        revenue=pl.col('price').sum()
+    )
 
-    monthly_orders_df.columns = ["order_date", "order_count", "revenue"]
-    monthly_orders_df['month_name'] = monthly_orders_df['order_date'].dt.strftime(
-        '%B %Y')
-    return monthly_orders_df
+    # Keep months without any orders in the trend
+    all_months = monthly_orders.select(pl.datetime_range(
+        pl.col('order_date').min(), pl.col('order_date').max(), interval='1mo').alias('order_date'))
 
-# Create category analysis dataframes
+    return all_months.join(monthly_orders, on='order_date', how='left').fill_null(0).sort(
+        'order_date')
 
 
 @st.cache_data
-def prepare_category_data(df):
-    # Top and bottom categories
-    top_categories = df.groupby("product_category_name_english")[
-        "price"].sum().sort_values(ascending=False).reset_index().head(10)
-    bottom_categories = df.groupby("product_category_name_english")[
-        "price"].sum().sort_values(ascending=True).reset_index().head(10)
-
-    # Category stats
-    category_stats = df.groupby("product_category_name_english").agg({
-        "order_id": lambda x: x.nunique(),
-        "price": ["count", "min", "mean", "max", "sum"]
-    })
-    category_stats.columns = ["order_count", "item_count",
-                              "min_price", "avg_price", "max_price", "total_sales"]
-    category_stats = category_stats.sort_values(
-        by="total_sales", ascending=False).reset_index()
-
-    return top_categories, bottom_categories, category_stats
+def filter_monthly_data(monthly_orders_df, start_date, end_date):
+    # Months are labelled at midnight, so compare against the dates as timestamps
+    order_dates = monthly_orders_df['order_date']
+    return monthly_orders_df[(order_dates >= pd.Timestamp(start_date)) &
+                             (order_dates <= pd.Timestamp(end_date))]
 
-# Create RFM analysis
+# Create category analysis dataframes
 
 
-@st.cache_data
-def prepare_rfm_data(df):
-    rfm_df = df.groupby(by="customer_id", as_index=False).agg({
-        "order_purchase_timestamp": "max",  # Last purchase date (Recency)
-        "order_id": lambda x: x.nunique(),  # Number of orders (Frequency)
-        "price": "sum"  # Total spending (Monetary)
-    })
+def category_query(lf):
+    return lf.filter(pl.col('product_category_name_english').is_not_null()).group_by(
+        'product_category_name_english'
+    ).agg(
+        order_count=pl.col('order_id').n_unique(),
+        item_count=pl.col('price').count(),
+        min_price=pl.col('price').min(),
+        avg_price=pl.col('price').mean(),
+        max_price=pl.col('price').max(),
+        total_sales=pl.col('price').sum()
+    ).sort('total_sales', descending=True)
 
-    rfm_df.columns = ["customer_id",
-                      "last_purchase_date", "frequency", "monetary"]
+# Create RFM analysis
 
-    # Calculate recency in days
-    recent_date = df["order_purchase_timestamp"].max()
-    rfm_df["recency"] = rfm_df["last_purchase_date"].apply(
-        lambda x: (recent_date - x).days)
 
-    rfm_df.drop("last_purchase_date", axis=1, inplace=True)
-    return rfm_df
+def rfm_query(lf):
+    rfm = lf.filter(pl.col('customer_id').is_not_null()).group_by('customer_id', maintain_order=True).agg(
+        # Last purchase date (Recency)
+        last_purchase_date=pl.col('order_purchase_timestamp').max(),
+        # Number of orders (Frequency)
+        frequency=pl.col('order_id').drop_nulls().n_unique(),
+        monetary=pl.col('price').sum()  # Total spending (Monetary)
+    )
+
+    # Calculate recency in days
+    return rfm.with_columns(
+        recency=(pl.col('last_purchase_date').max() -
+                 pl.col('last_purchase_date')).dt.total_days().cast(pl.Int32)
+    ).drop('last_purchase_date')
 
 # Create delivery performance analysis
 
 
-@st.cache_data
-def prepare_delivery_data(df):
-    orders_delivery_df = df.dropna(
-        subset=['order_delivered_customer_date']).drop_duplicates(subset=['order_id'])
-    orders_delivery_df['actual_delivery_time'] = (orders_delivery_df['order_delivered_customer_date'] -
-                                                  orders_delivery_df['order_purchase_timestamp']).dt.days
-    orders_delivery_df['estimated_delivery_time'] = (orders_delivery_df['order_estimated_delivery_date'] -
-                                                     orders_delivery_df['order_purchase_timestamp']).dt.days
-    orders_delivery_df['delivery_difference'] = orders_delivery_df['estimated_delivery_time'] - \
-        orders_delivery_df['actual_delivery_time']
+def delivered_orders_query(lf):
+    # Delivered orders, one row per order, with delivery times in whole days from purchase
+    return lf.unique(subset=['order_id'], keep='first', maintain_order=True).filter(
+        pl.col('order_delivered_customer_date').is_not_null()
+    ).select(
+        'order_id',
+        actual_delivery_time=(pl.col('order_delivered_customer_date') -
+                              pl.col('order_purchase_timestamp')).dt.total_days(),
+        estimated_delivery_time=(pl.col('order_estimated_delivery_date') -
+                                 pl.col('order_purchase_timestamp')).dt.total_days()
+    )
 
-    return orders_delivery_df
+
+def delivery_query(lf):
+    return delivered_orders_query(lf).select(
+        'order_id',
+        delivery_difference=(pl.col('estimated_delivery_time') -
+                             pl.col('actual_delivery_time')).cast(pl.Int16)
+    )
+
+
+def delivery_summary_query(lf):
+    return delivered_orders_query(lf).select(
+        on_time_delivery_rate=(pl.col('estimated_delivery_time') >=
+                               pl.col('actual_delivery_time')).mean() * 100,
+        avg_estimated=pl.col('estimated_delivery_time').mean(),
+        avg_actual=pl.col('actual_delivery_time').mean()
+    )
+
+# Create payment method analysis
+
+
+def payment_query(lf):
+    # One row per payment, not per order item
+    return lf.unique(subset=['order_id', 'payment_sequential'], maintain_order=True).filter(
+        pl.col('payment_type').is_not_null()
+    ).group_by('payment_type', maintain_order=True).agg(
+        order_id=pl.col('order_id').n_unique(),
+        payment_value=pl.col('payment_value').sum()
+    )
+
+# Create review score analysis
+
+
+def review_query(lf):
+    # One row per review, not per order item
+    return lf.unique(subset=['review_id']).filter(
+        pl.col('review_score').is_not_null()
+    ).group_by('review_score').agg(count=pl.len()).sort('review_score').rename(
+        {'review_score': 'score'})
+
+# Create customer state analysis
+
+
+def state_query(lf):
+    # One row per customer, not per order item
+    return lf.unique(subset=['customer_id']).filter(
+        pl.col('customer_id').is_not_null() & pl.col(
+            'customer_state').is_not_null()
+    ).group_by('customer_state').agg(customer_count=pl.len()).sort(
+        'customer_count', descending=True).rename({'customer_state': 'state'})
+
+# Calculate totals for overview
+
+
+def totals_query(lf):
+    return lf.select(
+        total_orders=pl.col('order_id').n_unique(),
+        total_revenue=pl.col('price').sum()
+    )
+
+# Keep the query results on disk next to the data
+
+
+def ensure_artifacts(data_path, queries):
+    artifacts_dir = os.path.join(os.path.dirname(data_path), 'artifacts')
+    artifact_paths = {name: os.path.join(artifacts_dir, f'{name}.parquet')
+                      for name in queries}
+
+    # Reuse artifacts that are newer than the data and this script
+    built_after = max(os.path.getmtime(data_path),
+                      os.path.getmtime(os.path.abspath(__file__)))
+    artifacts = {}
+    for name, path in artifact_paths.items():
+        if os.path.exists(path) and os.path.getmtime(path) >= built_after:
+            try:
+                artifacts[name] = pd.read_parquet(path)
+            except (OSError, ValueError):
+                # Unreadable artifacts are rebuilt below
+                pass
+
+    # Run the missing queries in a single pass over the data
+    missing = [name for name in queries if name not in artifacts]
+    if missing:
+        built = dict(zip(missing, pl.collect_all(
+            [queries[name] for name in missing])))
+        try:
+            os.makedirs(artifacts_dir, exist_ok=True)
+            for name, frame in built.items():
+                write_parquet_atomic(frame, artifact_paths[name])
+        except OSError:
+            pass
+        artifacts.update({name: frame.to_pandas()
+                         for name, frame in built.items()})
+
+    return artifacts
+
+
+@st.cache_resource
+def prepare_dashboard_data(_lf, data_path):
+    queries = {
+        'monthly': monthly_query(_lf),
+        'category_stats': category_query(_lf),
+        'rfm': rfm_query(_lf),
+        'delivery': delivery_query(_lf),
+        'delivery_summary': delivery_summary_query(_lf),
+        'payment': payment_query(_lf),
+        'state': state_query(_lf),
+        'totals': totals_query(_lf)
+    }
+    has_reviews = 'review_score' in _lf.collect_schema().names()
+    if has_reviews:
+        queries['review'] = review_query(_lf)
+
+    artifacts = ensure_artifacts(data_path, queries)
+    monthly_data = artifacts['monthly']
+    category_stats = artifacts['category_stats']
+    rfm_data = artifacts['rfm']
+    delivery_data = artifacts['delivery']
+    delivery_summary = artifacts['delivery_summary']
+    payment_methods = artifacts['payment']
+    customer_states = artifacts['state']
+    totals = artifacts['totals']
+
+    # Top and bottom categories
+    top_categories = category_stats.nlargest(10, "total_sales")[
+        ["product_category_name_english", "total_sales"]].rename(columns={"total_sales": "price"})
+    bottom_categories = category_stats.nsmallest(10, "total_sales")[
+        ["product_category_name_english", "total_sales"]].rename(columns={"total_sales": "price"})
+
+    # Options for the category filter
+    category_names = category_stats["product_category_name_english"].tolist()
+    default_categories = category_names[:5]
+
+    if has_reviews:
+        review_distribution = artifacts['review']
+        avg_review_score = (review_distribution['score'] * review_distribution['count']).sum() / \
+            review_distribution['count'].sum()
+    else:
+        review_distribution = pd.DataFrame(
+            {'score': range(1, 6), 'count': [0, 0, 0, 0, 0]})
+        avg_review_score = 0
+
+    total_orders = totals['total_orders'].iloc[0]
+    total_revenue = totals['total_revenue'].iloc[0]
+
+    return {
+        'monthly_data': monthly_data,
+        'top_categories': top_categories,
+        'bottom_categories': bottom_categories,
+        'category_stats': category_stats,
+        'category_names': category_names,
+        'default_categories': default_categories,
+        'rfm_data': rfm_data,
+        'delivery_data': delivery_data,
+        'avg_estimated': delivery_summary['avg_estimated'].iloc[0],
+        'avg_actual': delivery_summary['avg_actual'].iloc[0],
+        'payment_methods': payment_methods,
+        'review_distribution': review_distribution,
+        'avg_review_score': avg_review_score,
+        'has_reviews': has_reviews,
+        'customer_states': customer_states,
+        'metrics': {
+            'total_orders': total_orders,
+            'total_revenue': total_revenue,
+            'avg_order_value': total_revenue / total_orders,
+            'on_time_delivery_rate': delivery_summary['on_time_delivery_rate'].iloc[0]
+        }
+    }
 
 
 # Prepare all the data we need
-monthly_data = prepare_monthly_data(all_df)
-top_categories, bottom_categories, category_stats = prepare_category_data(
-    all_df)
-rfm_data = prepare_rfm_data(all_df)
-delivery_data = prepare_delivery_data(all_df)
-
-# Calculate metrics for overview
-total_orders = all_df['order_id'].nunique()
-total_revenue = all_df['price'].sum()
-avg_order_value = total_revenue / total_orders
-on_time_delivery_rate = (
-    delivery_data['delivery_difference'] >= 0).mean() * 100
-
-# Payment methods
-payment_methods = all_df.groupby("payment_type").agg({
-    "order_id": lambda x: x.nunique(),
-    "payment_value": "sum"
-}).reset_index()
-
-# Review scores
-if 'review_score' in all_df.columns:
-    review_distribution = all_df['review_score'].value_counts().reset_index()
-    review_distribution.columns = ['score', 'count']
-    avg_review_score = all_df['review_score'].mean()
-else:
-    review_distribution = pd.DataFrame(
-        {'score': range(1, 6), 'count': [0, 0, 0, 0, 0]})
-    avg_review_score = 0
-
-# Customer states
-customer_states = all_df.groupby('customer_state')[
-    'customer_id'].nunique().reset_index()
-customer_states.columns = ['state', 'customer_count']
-customer_states = customer_states.sort_values(
-    'customer_count', ascending=False)
+dashboard_data = prepare_dashboard_data(all_lf, data_path)
+monthly_data = dashboard_data['monthly_data']
+top_categories = dashboard_data['top_categories']
+bottom_categories = dashboard_data['bottom_categories']
+category_stats = dashboard_data['category_stats']
+category_names = dashboard_data['category_names']
+default_categories = dashboard_data['default_categories']
+rfm_data = dashboard_data['rfm_data']
+delivery_data = dashboard_data['delivery_data']
+payment_methods = dashboard_data['payment_methods']
+review_distribution = dashboard_data['review_distribution']
+avg_review_score = dashboard_data['avg_review_score']
+customer_states = dashboard_data['customer_states']
+metrics = dashboard_data['metrics']
 
 # Display sections based on selection
 if options == 'Overview':
@@ -195,13 +376,14 @@ if options == 'Overview':
     # Key metrics in columns
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Total Orders", f"{total_orders:,}")
+        st.metric("Total Orders", f"{metrics['total_orders']:,}")
     with col2:
-        st.metric("Total Revenue", f"R$ {total_revenue:,.2f}")
+        st.metric("Total Revenue", f"R$ {metrics['total_revenue']:,.2f}")
     with col3:
-        st.metric("Avg. Order Value", f"R$ {avg_order_value:.2f}")
+        st.metric("Avg. Order Value", f"R$ {metrics['avg_order_value']:.2f}")
     with col4:
-        st.metric("On-time Delivery", f"{on_time_delivery_rate:.1f}%")
+        st.metric("On-time Delivery",
+                  f"{metrics['on_time_delivery_rate']:.1f}%")
 
     # Two charts side by side
     col_left, col_right = st.columns(2)
@@ -263,10 +445,8 @@ elif options == 'Sales & Revenue Trends':
 
     if len(date_range) == 2:
         start_date, end_date = date_range
-        filtered_monthly_data = monthly_data[
-            (monthly_data['order_date'].dt.date >= start_date) &
-            (monthly_data['order_date'].dt.date <= end_date)
-        ]
+        filtered_monthly_data = filter_monthly_data(
+            monthly_data, start_date, end_date)
     else:
         filtered_monthly_data = monthly_data
 
@@ -299,8 +479,8 @@ elif options == 'Sales & Revenue Trends':
     st.plotly_chart(fig, use_container_width=True)
 
     # Average order value
-    filtered_monthly_data['avg_order_value'] = filtered_monthly_data['revenue'] / \
-        filtered_monthly_data['order_count']
+    filtered_monthly_data = filtered_monthly_data.assign(
+        avg_order_value=filtered_monthly_data['revenue'] / filtered_monthly_data['order_count'])
 
     st.subheader("Average Order Value")
     fig = px.line(
@@ -360,22 +540,23 @@ elif options == 'Product Category Analysis':
         2)
     display_category_stats['total_sales'] = display_category_stats['total_sales'].round(
         2)
+    display_category_stats = display_category_stats.set_index(
+        'product_category_name_english', drop=False)
 
     # Allow filtering by category
     selected_categories = st.multiselect(
         "Select categories to display",
-        options=category_stats['product_category_name_english'].unique(),
-        default=category_stats['product_category_name_english'].head(
-            5).tolist()
+        options=category_names,
+        default=default_categories
     )
 
     if selected_categories:
-        filtered_stats = display_category_stats[display_category_stats['product_category_name_english'].isin(
+        filtered_stats = display_category_stats.loc[display_category_stats.index.intersection(
             selected_categories)]
     else:
         filtered_stats = display_category_stats
 
-    st.dataframe(filtered_stats, use_container_width=True)
+    st.dataframe(filtered_stats, use_container_width=True, hide_index=True)
 
 elif options == 'Customer Analysis':
     st.header('👥 Customer Analysis')
@@ -408,7 +589,7 @@ elif options == 'Customer Analysis':
 
         # Top 5 customers by recency (lower is better)
         st.subheader("Top Customers by Recency")
-        top_recency = rfm_data.sort_values('recency').head(5)
+        top_recency = rfm_data.nsmallest(5, 'recency')
         fig = px.bar(
             top_recency,
             x="customer_id",
@@ -426,8 +607,7 @@ elif options == 'Customer Analysis':
 
         # Top 5 customers by frequency
         st.subheader("Top Customers by Frequency")
-        top_frequency = rfm_data.sort_values(
-            'frequency', ascending=False).head(5)
+        top_frequency = rfm_data.nlargest(5, 'frequency')
         fig = px.bar(
             top_frequency,
             x="customer_id",
@@ -445,8 +625,7 @@ elif options == 'Customer Analysis':
 
         # Top 5 customers by monetary value
         st.subheader("Top Customers by Spending")
-        top_monetary = rfm_data.sort_values(
-            'monetary', ascending=False).head(5)
+        top_monetary = rfm_data.nlargest(5, 'monetary')
         fig = px.bar(
             top_monetary,
             x="customer_id",
@@ -467,18 +646,24 @@ elif options == 'Customer Analysis':
     y_axis = st.selectbox(
         "Select Y-axis", ["recency", "frequency", "monetary"], index=1)
 
+    # Plot a random sample so the chart stays light in the browser
+    rfm_sample = rfm_data.sample(min(len(rfm_data), 5000), random_state=0)
+
     # Create the scatter plot
     fig = px.scatter(
-        rfm_data,
+        rfm_sample,
         x=x_axis,
         y=y_axis,
         title=f"Relationship between {x_axis.capitalize()} and {y_axis.capitalize()}",
         labels={x_axis: x_axis.capitalize(), y_axis: y_axis.capitalize()},
         color="monetary" if y_axis != "monetary" and x_axis != "monetary" else "frequency",
         size="frequency" if y_axis != "frequency" and x_axis != "frequency" else "monetary",
-        hover_data=["customer_id", "recency", "frequency", "monetary"]
+        hover_data=["customer_id", "recency", "frequency", "monetary"],
+        render_mode="webgl"
     )
     st.plotly_chart(fig, use_container_width=True)
+    st.caption(
+        f"Showing a random sample of {len(rfm_sample):,} out of {len(rfm_data):,} customers.")
 
 elif options == 'Additional Insights':
     st.header('🔍 Additional Insights')
@@ -495,8 +680,8 @@ elif options == 'Additional Insights':
         st.metric("On-time Delivery Rate", f"{on_time_delivery:.2f}%")
 
         # Average delivery times
-        avg_estimated = delivery_data['estimated_delivery_time'].mean()
-        avg_actual = delivery_data['actual_delivery_time'].mean()
+        avg_estimated = dashboard_data['avg_estimated']
+        avg_actual = dashboard_data['avg_actual']
 
         delivery_stats = pd.DataFrame({
             'Metric': ['Estimated Delivery Time', 'Actual Delivery Time'],
@@ -575,13 +760,13 @@ elif options == 'Additional Insights':
         st.plotly_chart(fig, use_container_width=True)
 
     # Review score analysis
-    if 'review_score' in all_df.columns:
+    if dashboard_data['has_reviews']:
         st.subheader("Customer Review Analysis")
 
         # Score distribution with percentage
         total_reviews = review_distribution['count'].sum()
-        review_distribution['percentage'] = (
-            review_distribution['count'] / total_reviews * 100).round(1)
+        review_distribution = review_distribution.assign(percentage=(
+            review_distribution['count'] / total_reviews * 100).round(1))
 
         fig = px.bar(
             review_distribution.sort_values('score'),